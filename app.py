@@ -1,8 +1,15 @@
 import streamlit as st
 from streamlit_folium import st_folium
 import pandas as pd
+import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from folium.plugins import MarkerCluster
+from facility_overlay import (
+    load_facility_file, combine_facility_frames, filter_facilities_for_type, fingerprint_facility_data,
+    write_facility_payload, inject_facility_markers_into_html, find_prebuilt_overlay, overlay_format_matches,
+    overlay_payload_name
+)
 
 # --- Page Configuration (MUST be at the very top, before any st. calls) ---
 st.set_page_config(
@@ -45,6 +52,8 @@ PROJECT_ROOT = Path('.').resolve()
 FACILITY_LOCATION_FILES_DIR = PROJECT_ROOT / 'data' /'facility_location_files'
 MAPS_DIR = PROJECT_ROOT / 'data' /'maps'
 DATA_DIR = PROJECT_ROOT / 'data' / 'map_tables'
+# Served by Streamlit's static file serving (see .streamlit/config.toml)
+STATIC_DIR = PROJECT_ROOT / 'static'
 
 st.title("BCBS Behavioral Health Network Adequacy")
 st.markdown("National analysis of facility density by raw count and per 100,000 people.")
@@ -82,234 +91,97 @@ st.sidebar.header("Facility Overlay")
 show_facility_overlay = st.sidebar.checkbox("Show Individual Facilities", value=False)
 
 # --- Function to load facility data ---
-@st.cache_data
+# Cached as a shared resource (no pickle round-trip per rerun) - callers must treat the result as read-only
+@st.cache_resource(show_spinner=False)
 def load_facility_data():
     """Load and combine all facility CSV files"""
     if not FACILITY_LOCATION_FILES_DIR.exists():
         st.warning(f"Facility data directory not found: {FACILITY_LOCATION_FILES_DIR}")
         return None
     
-    consolidated_facilities = []
-    csv_files = list(FACILITY_LOCATION_FILES_DIR.glob("*.csv"))
+    # Sorted so duplicate facilities resolve the same way here and in scripts/prebuild_overlays.py
+    csv_files = sorted(FACILITY_LOCATION_FILES_DIR.glob("*.csv"))
     
     if not csv_files:
         st.info(f"No CSV files found in {FACILITY_LOCATION_FILES_DIR}.")
         return None
     
-    # Required columns
-    required_columns = ['NPI', 'Group Name', 'Street Address', 'City', 'State', 'Zip', 'Latitude', 'Longitude', 'is_substance_abuse_rehab', 'is_sud_rehab_clinic']
-    
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    for i, csv_file in enumerate(csv_files):
-        status_text.text(f"Processing facility file {i+1}/{len(csv_files)}: {csv_file.name}")
-        try:
-            df = pd.read_csv(csv_file)
-            
-            # Check if required columns exist
-            missing_cols = [col for col in required_columns if col not in df.columns]
-            if missing_cols:
-                st.warning(f"File {csv_file.name} missing columns: {missing_cols}. Skipping this file.")
-                continue
-            
-            # Select only required columns and add source info
-            facility_df = df[required_columns].copy()
-            facility_df['source_file'] = csv_file.name
-            
-            # Clean data
-            facility_df = facility_df.dropna(subset=['Group Name', 'Latitude', 'Longitude'])
-            facility_df = facility_df[
-                (facility_df['Latitude'].between(-90, 90)) & 
-                (facility_df['Longitude'].between(-180, 180))
-            ]
-            
-            # Clean text fields
-            for col in ['Group Name', 'Street Address', 'City', 'State']:
-                if col in facility_df.columns:
-                    facility_df[col] = facility_df[col].astype(str).str.strip()
-            
-            # Clean zip codes
-            if 'Zip' in facility_df.columns:
-                facility_df['Zip'] = facility_df['Zip'].astype(str).str.strip()
-                # Convert numeric-like zips (e.g., '12345.0') to '12345'
-                facility_df['Zip'] = facility_df['Zip'].apply(lambda x: str(int(float(x))) if pd.notnull(x) and str(x).endswith('.0') else str(x))
-                
-            boolean_columns = ['is_substance_abuse_rehab', 'is_sud_rehab_clinic']
-            for col in boolean_columns:
-                if col in facility_df.columns:
-                    # Convert 1.0/1 -> 'True', 0.0/0 -> 'False', others/NaN -> 'N/A'
-                    facility_df[col] = facility_df[col].apply(lambda x: 
-                        'True' if x is True or x == 1.0 or x == 1 
-                        else 'False' if x is False or x == 0.0 or x == 0
-                        else 'N/A'
-                    )
-            
-            consolidated_facilities.append(facility_df)
-            
-        except Exception as e:
-            st.warning(f"Could not process {csv_file.name}. Error: {e}")
-        
-        progress_bar.progress((i + 1) / len(csv_files))
+    # Read files concurrently (the CSV parsers release the GIL); progress is reported as each file finishes
+    loaded_facilities = {}
+    with ThreadPoolExecutor(max_workers=min(8, len(csv_files))) as executor:
+        futures = {executor.submit(load_facility_file, csv_file): csv_file for csv_file in csv_files}
+        for i, future in enumerate(as_completed(futures)):
+            csv_file = futures[future]
+            status_text.text(f"Processed facility file {i+1}/{len(csv_files)}: {csv_file.name}")
+            facility_df, warning_message = future.result()
+            if warning_message:
+                st.warning(warning_message)
+            if facility_df is not None:
+                loaded_facilities[csv_file] = facility_df
+            progress_bar.progress((i + 1) / len(csv_files))
     
     progress_bar.empty()
     status_text.empty()
     
-    if consolidated_facilities:
-        combined_df = pd.concat(consolidated_facilities, ignore_index=True)
-        return combined_df
-    else:
-        return None
+    # Keep the original file order regardless of completion order
+    consolidated_facilities = [loaded_facilities[csv_file] for csv_file in csv_files if csv_file in loaded_facilities]
+    
+    return combine_facility_frames(consolidated_facilities)
 
-def inject_facility_markers_into_html(original_html, facilities_df):
-    """Inject facility markers into existing folium HTML using color coding based on taxonomy flags"""
+# Filtering and fingerprinting the facility rows is done once per facility type, not on every rerun
+@st.cache_resource(show_spinner=False)
+def load_facilities_for_type(facility_type):
+    """Return the cached facilities shown on a facility type's maps with their fingerprint; (None, None) if none loaded"""
+    facilities_df = load_facility_data()
     if facilities_df is None or facilities_df.empty:
-        return original_html
-    
-    # Generate JavaScript code to add facility markers
-    facility_js_code = []
-    
-    # Add MarkerCluster plugin if not already present
-    # Check for MarkerCluster.css as a proxy for whether it's already loaded
-    if 'markercluster.css' not in original_html.lower():
-        facility_js_code.append("""
-        // Add MarkerCluster CSS and JS
-        var clusterCSS = document.createElement('link');
-        clusterCSS.rel = 'stylesheet';
-        clusterCSS.href = 'https://unpkg.com/leaflet.markercluster@1.4.1/dist/MarkerCluster.css';
-        document.head.appendChild(clusterCSS);
-        
-        var clusterDefaultCSS = document.createElement('link');
-        clusterDefaultCSS.rel = 'stylesheet';
-        clusterDefaultCSS.href = 'https://unpkg.com/leaflet.markercluster@1.4.1/dist/MarkerCluster.Default.css';
-        document.head.appendChild(clusterDefaultCSS);
-        
-        var clusterJS = document.createElement('script');
-        clusterJS.src = 'https://unpkg.com/leaflet.markercluster@1.4.1/dist/leaflet.markercluster.js';
-        document.head.appendChild(clusterJS);
-        """)
-    
-    # Wait for map to be ready and add facility markers
-    facility_js_code.append("""
-        // Wait for the map to be fully loaded
-        setTimeout(function() {
-            // Find the map object (folium creates global map variables)
-            var mapObj = window[Object.keys(window).find(key => key.startsWith('map_'))];
-            
-            if (mapObj) {
-                // Create marker cluster group
-                var facilityCluster = L.markerClusterGroup({
-                    showCoverageOnHover: false,
-                    zoomToBoundsOnClick: true,
-                    spiderfyOnMaxZoom: false,
-                    removeOutsideVisibleBounds: true,
-                    disableClusteringAtZoom: 13
-                });
-                
-                // Add facility markers
-    """)
-    
-    # Generate markers for each facility
-    for idx, facility in facilities_df.iterrows():
-        # Determine marker color based on taxonomy flags (ensure these are strings 'True'/'False')
-        is_substance_abuse = facility.get('is_substance_abuse_rehab', 'N/A')
-        is_sud_clinic = facility.get('is_sud_rehab_clinic', 'N/A')
-        
-        # Convert string representations to boolean for logic
-        is_substance_abuse_bool = (is_substance_abuse == 'True')
-        is_sud_clinic_bool = (is_sud_clinic == 'True')
-        
-        # Determine fill color and facility type description
-        if is_substance_abuse_bool and is_sud_clinic_bool:
-            fill_color = '#800080'  # Purple - both types
-            facility_type_desc = "Substance Abuse Rehab & SUD Rehab Clinic"
-        elif is_substance_abuse_bool:
-            fill_color = '#FF0000'  # Red - substance abuse rehab only
-            facility_type_desc = "Substance Abuse Rehab"
-        elif is_sud_clinic_bool:
-            fill_color = '#0000FF'  # Blue - SUD rehab clinic only
-            facility_type_desc = "SUD Rehab Clinic"
-        else:
-            fill_color = '#808080'  # Gray - neither type (fallback)
-            facility_type_desc = "Other/Unknown"
-        
-        # Border color for markers (fixed to black for contrast)
-        marker_color = '#000000' 
-
-        # Ensure all values are string for popup HTML, handling potential NaNs gracefully
-        npi = str(facility.get('NPI', 'N/A'))
-        group_name = str(facility.get('Group Name', 'N/A'))
-        street_address = str(facility.get('Street Address', 'N/A'))
-        city = str(facility.get('City', 'N/A'))
-        state = str(facility.get('State', 'N/A'))
-        zip_code = str(facility.get('Zip', 'N/A'))
-        latitude = f"{facility.get('Latitude', 'N/A'):.4f}" if pd.notnull(facility.get('Latitude')) else 'N/A'
-        longitude = f"{facility.get('Longitude', 'N/A'):.4f}" if pd.notnull(facility.get('Longitude')) else 'N/A'
-        
-        popup_html = f"""
-        <b>NPI:</b> {npi}<br>
-        <b>Facility Name:</b> {group_name}<br>
-        <b>Facility Type:</b> {facility_type_desc}<br>
-        <b>Street Address:</b> {street_address}<br>
-        <b>City:</b> {city}<br>
-        <b>State:</b> {state}<br>
-        <b>Zip:</b> {zip_code}<br>
-        <b>Coordinates:</b> {latitude}, {longitude}<br>
-        <br>
-        <b>is_substance_abuse_rehab:</b> {is_substance_abuse}<br>
-        <b>is_sud_rehab_clinic:</b> {is_sud_clinic}<br>
-        """.replace('"', '\\"').replace('\n', '\\n')
-        
-        facility_js_code.append(f"""
-                var marker_{idx} = L.circleMarker([{facility['Latitude']}, {facility['Longitude']}], {{
-                    radius: 7,
-                    color: '{marker_color}',
-                    weight: 2,
-                    opacity: 0.9,
-                    fillColor: '{fill_color}',
-                    fillOpacity: 0.7
-                }}).bindPopup("{popup_html}", {{maxWidth: 300}});
-                
-                facilityCluster.addLayer(marker_{idx});
-        """)
-    
-    # Close the JavaScript function and add legend
-    facility_js_code.append("""
-                // Add cluster to map
-                mapObj.addLayer(facilityCluster);
-                
-                // Add layer control if it doesn't exist
-                if (!mapObj.layerControl) {
-                    var baseLayers = {};
-                    var overlayLayers = {
-                        "Individual Facilities": facilityCluster
-                    };
-                    mapObj.layerControl = L.control.layers(baseLayers, overlayLayers).addTo(mapObj);
-                } else {
-                    // Check if "Individual Facilities" overlay already exists to avoid duplication on rerun
-                    var existingOverlays = mapObj.layerControl._layers.filter(layer => layer.overlay).map(layer => layer.name);
-                    if (!existingOverlays.includes("Individual Facilities")) {
-                        mapObj.layerControl.addOverlay(facilityCluster, "Individual Facilities");
-                    }
-                }
-            }
-        }, 1000);
-    """)
-    
-    # Combine all JavaScript code
-    full_js_code = '\n'.join(facility_js_code)
-    
-    # Inject the JavaScript into the HTML
-    script_tag = f"<script>{full_js_code}</script>"
-    
-    # Find the closing </body> tag and insert before it
-    if '</body>' in original_html:
-        modified_html = original_html.replace('</body>', f'{script_tag}\n</body>')
-    else:
-        # If no </body> tag found, append to the end
-        modified_html = original_html + script_tag
-    
-    return modified_html
+        return None, None
+    type_facilities = filter_facilities_for_type(facilities_df, facility_type)
+    return type_facilities, fingerprint_facility_data(type_facilities)
+
+# --- Cached map HTML builder ---
+# The saved maps never change during a session; key on mtime so a regenerated map file is picked up
+@st.cache_resource(max_entries=32, show_spinner=False)
+def read_map_html(map_path_str, mtime_ns):
+    """Read a saved folium map file"""
+    with open(map_path_str, 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Scanning a pre-rendered overlay (several MB for zip code maps) is done once per file version, not on every rerun
+@st.cache_data(max_entries=32, show_spinner=False)
+def read_prebuilt_overlay_payload_name(overlay_path_str, mtime_ns):
+    """Return the payload file a pre-rendered overlay fetches, or None if it was written by another overlay format"""
+    overlay_html = read_map_html(overlay_path_str, mtime_ns)
+    if not overlay_format_matches(overlay_html):
+        return None
+    return overlay_payload_name(overlay_html)
+
+# Only the HTML string is cached; the payload file it fetches is (re)written outside so a pruned static folder recovers.
+# Each entry is a full map document (up to ~9 MB), so keep about one per saved map and let older payload versions age out
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_map_html(map_path_str, mtime_ns, payload_url):
+    """Read a saved folium map and inject the markers for the facility payload at payload_url"""
+    map_html = read_map_html(map_path_str, mtime_ns)
+    return inject_facility_markers_into_html(map_html, payload_url)
+
+# --- Cached table loader ---
+# Parse each table CSV once; filter widget changes then only re-run the in-memory filtering
+@st.cache_data(show_spinner=False)
+def load_table_data(data_path_str, mtime_ns):
+    """Read a map's underlying data table"""
+    return pd.read_csv(data_path_str, engine='pyarrow')
+
+# Sending every row to the browser on each rerun is the slow part for large zip code tables
+TABLE_DISPLAY_ROW_LIMIT = 5000
+
+# The download needs the full filtered table as CSV; serialize it once per table + filter selection, not on every rerun
+# (the frame itself is excluded from hashing - the other arguments determine its contents)
+@st.cache_data(show_spinner=False, max_entries=8)
+def filtered_table_csv(_filtered_df, data_path_str, mtime_ns, selected_states, selected_range):
+    """Serialize a filtered data table to CSV bytes for download"""
+    return _filtered_df.to_csv(index=False).encode('utf-8')
 
 # --- Dynamic Filename and Path Generation ---
 # Extract facility type name from taxonomy selection
@@ -354,21 +226,48 @@ if taxonomy_selection.startswith('Combined'):
 
 # Handle facility overlay creation and display
 facility_data = None
+facility_hash = None
+prebuilt_html = None
 if show_facility_overlay:
+    # Prefer an overlay pre-rendered by scripts/prebuild_overlays.py when it is newer than the map and facility files
+    # (and was written by the current overlay format)
+    prebuilt_overlay = find_prebuilt_overlay(map_path, list(FACILITY_LOCATION_FILES_DIR.glob("*.csv")))
+    if prebuilt_overlay is not None:
+        prebuilt_mtime_ns = prebuilt_overlay.stat().st_mtime_ns
+        prebuilt_payload_name = read_prebuilt_overlay_payload_name(str(prebuilt_overlay), prebuilt_mtime_ns)
+        # The payload file can be pruned independently of the overlay, so check it is still there
+        if prebuilt_payload_name is not None and (STATIC_DIR / prebuilt_payload_name).exists():
+            prebuilt_html = read_map_html(str(prebuilt_overlay), prebuilt_mtime_ns)
+
+if show_facility_overlay and prebuilt_html is None:
     with st.spinner("Loading individual facility data..."): # Added spinner for UX
-        facility_data = load_facility_data()
-    if facility_data is None or facility_data.empty:
+        # Only send facilities matching the selected taxonomy (and with usable coordinates) to the map
+        facility_data, facility_hash = load_facilities_for_type(facility_type)
+    if facility_data is None:
         st.warning("No individual facility data loaded or found. Overlay will not be shown.")
+    elif facility_data.empty:
+        st.info("No individual facilities match the selected taxonomy. Overlay will not be shown.")
+
 
+# Write the payload the injected overlay fetches; a failure here only drops the overlay, never the base map
+payload_url = None
+if show_facility_overlay and facility_data is not None and not facility_data.empty:
+    try:
+        # Checked every run (just an exists() call once written) so the payload is restored if the static folder was cleaned
+        payload_url = write_facility_payload(facility_data, facility_hash, STATIC_DIR)
+    except OSError as e:
+        st.warning(f"Individual facility overlay is unavailable (could not write its data file: {e}). Showing the map without it.")
 
 # Display the selected map
 try:
-    with open(map_path, 'r', encoding='utf-8') as f:
-        map_html = f.read()
-    
-    # If facility overlay is enabled, inject facility markers into the existing map HTML
-    if show_facility_overlay and facility_data is not None and not facility_data.empty:
-        map_html = inject_facility_markers_into_html(map_html, facility_data)
+    # If facility overlay is enabled, inject facility markers into the existing map HTML (cached per map + payload)
+    map_mtime_ns = map_path.stat().st_mtime_ns
+    if prebuilt_html is not None:
+        map_html = prebuilt_html
+    elif payload_url is None:
+        map_html = read_map_html(str(map_path), map_mtime_ns)
+    else:
+        map_html = build_map_html(str(map_path), map_mtime_ns, payload_url)
     
     st.components.v1.html(map_html, height=1000, scrolling=True)
         
@@ -390,30 +289,33 @@ if show_data:
     
     try:
         # Attempt to load the dynamically selected data file
-        df = pd.read_csv(data_path)
+        data_mtime_ns = data_path.stat().st_mtime_ns
+        df = load_table_data(str(data_path), data_mtime_ns)
         
         if geographic_level == 'Zip Code':
             # Interactive Filters for Zip Code Data
             st.markdown("---")
             st.write("#### Filter Data")
 
-            # Create a copy of the dataframe to apply filters to
-            filtered_df = df.copy()
+            # Accumulate all filters into a single row mask and select the matching rows once at the end
+            filter_mask = np.ones(len(df), dtype=bool)
+            selected_states = []
+            selected_range = None
 
             # Lay out filters in columns for a cleaner look
             col1, col2 = st.columns(2)
 
             # Filter 1: State Multi-Select
             with col1:
-                if 'state' in filtered_df.columns:
-                    unique_states = sorted(filtered_df['state'].unique())
+                if 'state' in df.columns:
+                    unique_states = sorted(df['state'].unique())
                     selected_states = st.multiselect(
                         'Filter by State(s):',
                         options=unique_states,
                         default=[]
                     )
                     if selected_states:
-                        filtered_df = filtered_df[filtered_df['state'].isin(selected_states)]
+                        filter_mask &= df['state'].isin(selected_states).to_numpy()
             
             # Filter 2: Metric Value Range Slider
             with col2:
@@ -434,8 +336,8 @@ if show_data:
                         else:
                             metric_col_name = possible_metric_cols[0] # Fallback to first available
                     
-                    if metric_col_name and metric_col_name in filtered_df.columns:
-                        metric_data_for_slider = filtered_df[metric_col_name].dropna()
+                    if metric_col_name and metric_col_name in df.columns:
+                        metric_data_for_slider = df.loc[filter_mask, metric_col_name].dropna()
 
                         if not metric_data_for_slider.empty:
                             min_val = float(metric_data_for_slider.min())
@@ -455,9 +357,7 @@ if show_data:
                                     format=slider_format
                                 )
                             
-                            filtered_df = filtered_df[
-                                filtered_df[metric_col_name].between(selected_range[0], selected_range[1])
-                            ]
+                            filter_mask &= df[metric_col_name].between(selected_range[0], selected_range[1]).to_numpy()
                         else:
                             st.info("Metric data for slider is empty.")
                     else:
@@ -471,12 +371,27 @@ if show_data:
             st.markdown("---")
 
             # Display Summary Metrics and the Filtered DataFrame
+            display_cols = [col for col in df.columns if not col.endswith('_capped_viz')]
+            filtered_df = df.loc[filter_mask, display_cols]
+
             metric_col1, metric_col2 = st.columns(2)
             metric_col1.metric(f"Total Records in Original Table", f"{len(df):,}")
             metric_col2.metric("Records Matching Filters", f"{len(filtered_df):,}")
 
-            display_cols = [col for col in filtered_df.columns if not col.endswith('_capped_viz')]
-            st.dataframe(filtered_df[display_cols], use_container_width=True)
+            if len(filtered_df) > TABLE_DISPLAY_ROW_LIMIT:
+                # Only render the first rows; the full filtered table is still available as a download
+                st.caption(f"Showing first {TABLE_DISPLAY_ROW_LIMIT:,} of {len(filtered_df):,} matching records.")
+                st.dataframe(filtered_df.head(TABLE_DISPLAY_ROW_LIMIT), use_container_width=True)
+                st.download_button(
+                    "Download Full Filtered Table (CSV)",
+                    data=filtered_table_csv(
+                        filtered_df, str(data_path), data_mtime_ns, tuple(selected_states), selected_range
+                    ),
+                    file_name=data_path.stem + '_filtered.csv',
+                    mime='text/csv'
+                )
+            else:
+                st.dataframe(filtered_df, use_container_width=True)
 
         else:
             # For State level, just display the table directly without filters
@@ -0,0 +1,412 @@
+"""Facility overlay helpers shared by app.py and scripts/prebuild_overlays.py (no Streamlit calls)"""
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# URL prefix Streamlit serves the app's ./static folder under (see .streamlit/config.toml)
+STATIC_URL_PATH = '/app/static'
+
+# Required columns
+REQUIRED_COLUMNS = ['NPI', 'Group Name', 'Street Address', 'City', 'State', 'Zip', 'Latitude', 'Longitude', 'is_substance_abuse_rehab', 'is_sud_rehab_clinic']
+# Explicit dtypes skip type inference; the taxonomy flags are left to the parser since files store them as True/False or 1/0
+COLUMN_DTYPES = {
+    'NPI': 'string', 'Group Name': 'string', 'Street Address': 'string', 'City': 'string',
+    'State': 'string', 'Zip': 'string', 'Latitude': 'float32', 'Longitude': 'float32'
+}
+# Decimal places kept for coordinates in the marker payload (~1 m, plenty for facility markers)
+COORDINATE_DECIMALS = 5
+# Bump whenever the payload layout/encoding or the injected script changes. It is part of the payload fingerprint and is
+# stamped into the injected script tag, so stale payload files and pre-rendered overlays are not reused after an upgrade
+OVERLAY_FORMAT_VERSION = 1
+
+# --- Loading facility data ---
+def load_facility_file(csv_file):
+    """Read and clean a single facility file; returns (DataFrame or None, warning message or None).
+    Safe to run on a worker thread - reporting the warning is left to the caller."""
+    try:
+        # Check if required columns exist (header only)
+        header_columns = pd.read_csv(csv_file, nrows=0).columns
+        missing_cols = [col for col in REQUIRED_COLUMNS if col not in header_columns]
+        if missing_cols:
+            return None, f"File {csv_file.name} missing columns: {missing_cols}. Skipping this file."
+
+        # Parse only the required columns; the pyarrow reader rejects ragged rows, so fall back to the C engine for those files
+        try:
+            df = pd.read_csv(csv_file, engine='pyarrow', usecols=REQUIRED_COLUMNS, dtype=COLUMN_DTYPES)
+        except pd.errors.ParserError:
+            df = pd.read_csv(csv_file, usecols=REQUIRED_COLUMNS, dtype=COLUMN_DTYPES)
+
+        # usecols already limited the fresh frame to the required columns, so clean it without another copy; add source info
+        facility_df = df
+        facility_df['source_file'] = csv_file.name
+
+        # Clean data
+        facility_df = facility_df.dropna(subset=['Group Name', 'Latitude', 'Longitude'])
+        facility_df = facility_df[
+            (facility_df['Latitude'].between(-90, 90)) & 
+            (facility_df['Longitude'].between(-180, 180))
+        ]
+
+        # Clean text fields
+        for col in ['Group Name', 'Street Address', 'City', 'State']:
+            if col in facility_df.columns:
+                facility_df[col] = facility_df[col].astype('string').str.strip()
+
+        # Clean zip codes
+        if 'Zip' in facility_df.columns:
+            zip_codes = facility_df['Zip'].astype('string').str.strip()
+            # Convert numeric-like zips (e.g., '12345.0') to '12345'
+            facility_df['Zip'] = zip_codes.str.removesuffix('.0')
+
+        boolean_columns = ['is_substance_abuse_rehab', 'is_sud_rehab_clinic']
+        for col in boolean_columns:
+            if col in facility_df.columns:
+                # Convert True/1.0/1 -> True, False/0.0/0 -> False, others/NaN -> <NA> (nullable Arrow boolean)
+                values = pd.to_numeric(facility_df[col], errors='coerce')
+                flags = values.eq(1).astype(pd.ArrowDtype(pa.bool_()))
+                facility_df[col] = flags.mask(~values.isin([0, 1]))
+
+        # Arrow-backed columns keep strings and nullable flags in compact buffers instead of Python objects,
+        # and let the final concat chunk the per-file buffers together instead of copying them
+        facility_df = facility_df.convert_dtypes(dtype_backend='pyarrow')
+
+        return facility_df, None
+
+    except Exception as e:
+        return None, f"Could not process {csv_file.name}. Error: {e}"
+
+def combine_facility_frames(facility_frames):
+    """Concatenate cleaned per-file facility frames; returns None if there are none"""
+    if not facility_frames:
+        return None
+    
+    combined_df = pd.concat(facility_frames, ignore_index=True, copy=False)
+    # Overlapping source files list the same facility more than once; keep one marker per NPI per location
+    combined_df = combined_df.drop_duplicates(subset=['NPI', 'Latitude', 'Longitude'], keep='first', ignore_index=True)
+    return combined_df
+
+def filter_facilities_for_type(facilities_df, facility_type):
+    """Keep the facilities relevant to a map's facility type (and with usable coordinates)"""
+    facility_mask = facilities_df['Latitude'].notna() & facilities_df['Longitude'].notna()
+    if facility_type == 'Substance Abuse Rehabs':
+        facility_mask &= facilities_df['is_substance_abuse_rehab'].fillna(False).to_numpy(dtype=bool)
+    elif facility_type == 'SUD Rehab Clinics':
+        facility_mask &= facilities_df['is_sud_rehab_clinic'].fillna(False).to_numpy(dtype=bool)
+    # Filtering returns a new frame, so shared cached facility data is never mutated
+    return facilities_df.loc[facility_mask]
+
+# --- Spatial index over facility coordinates (for map-bounds filtering) ---
+FACILITY_GRID_CELL_DEGREES = 0.5
+
+def build_facility_grid(facilities_df):
+    """Bucket facility rows into a uniform lat/lon grid; returns {(cell_x, cell_y): row positions}"""
+    grid_cells = pd.DataFrame({
+        'cell_x': np.floor(facilities_df['Longitude'].to_numpy(dtype=float) / FACILITY_GRID_CELL_DEGREES).astype(np.int64),
+        'cell_y': np.floor(facilities_df['Latitude'].to_numpy(dtype=float) / FACILITY_GRID_CELL_DEGREES).astype(np.int64),
+    })
+    return grid_cells.groupby(['cell_x', 'cell_y']).indices
+
+def facilities_in_bbox(facilities_df, facility_grid, minlon, minlat, maxlon, maxlat):
+    """Return the facilities inside a lon/lat bounding box, visiting only the grid cells it overlaps"""
+    x_min, x_max = (int(np.floor(lon / FACILITY_GRID_CELL_DEGREES)) for lon in (minlon, maxlon))
+    y_min, y_max = (int(np.floor(lat / FACILITY_GRID_CELL_DEGREES)) for lat in (minlat, maxlat))
+    
+    # Probe the overlapped cells directly unless the box spans more cells than are occupied (e.g. a zoomed-out view)
+    if (x_max - x_min + 1) * (y_max - y_min + 1) <= len(facility_grid):
+        candidate_cells = (facility_grid.get((x, y)) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1))
+    else:
+        candidate_cells = (positions for (x, y), positions in facility_grid.items() if x_min <= x <= x_max and y_min <= y <= y_max)
+    candidate_cells = [positions for positions in candidate_cells if positions is not None]
+    if not candidate_cells:
+        return facilities_df.iloc[0:0]
+    
+    # Refine the candidates from the boundary cells against the exact box
+    candidates = np.sort(np.concatenate(candidate_cells))
+    lons = facilities_df['Longitude'].to_numpy()[candidates]
+    lats = facilities_df['Latitude'].to_numpy()[candidates]
+    inside = (lons >= minlon) & (lons <= maxlon) & (lats >= minlat) & (lats <= maxlat)
+    return facilities_df.iloc[candidates[inside]]
+
+# --- Building the overlay ---
+def build_facility_payload(facilities_df):
+    """Serialize facilities to the compact JSON payload the injected map script builds its markers from"""
+    # Determine marker color based on taxonomy flags (nullable booleans, missing means unknown)
+    unknown_flags = pd.Series(pd.NA, index=facilities_df.index, dtype=pd.ArrowDtype(pa.bool_()))
+    is_substance_abuse = facilities_df.get('is_substance_abuse_rehab', unknown_flags)
+    is_sud_clinic = facilities_df.get('is_sud_rehab_clinic', unknown_flags)
+    
+    # Treat unknown flags as False for the color logic
+    is_substance_abuse_bool = is_substance_abuse.fillna(False).to_numpy(dtype=bool)
+    is_sud_clinic_bool = is_sud_clinic.fillna(False).to_numpy(dtype=bool)
+    taxonomy_conditions = [
+        is_substance_abuse_bool & is_sud_clinic_bool,
+        is_substance_abuse_bool,
+        is_sud_clinic_bool,
+    ]
+    
+    # Determine fill color and facility type description for every facility at once
+    # Purple - both types, Red - substance abuse rehab only, Blue - SUD rehab clinic only, Gray - neither type (fallback)
+    fill_color = pd.Series(
+        np.select(taxonomy_conditions, ['#800080', '#FF0000', '#0000FF'], default='#808080'),
+        index=facilities_df.index
+    )
+    facility_type_desc = pd.Series(
+        np.select(
+            taxonomy_conditions,
+            ["Substance Abuse Rehab & SUD Rehab Clinic", "Substance Abuse Rehab", "SUD Rehab Clinic"],
+            default="Other/Unknown"
+        ),
+        index=facilities_df.index
+    )
+    
+    # Ensure all values are string for popup HTML, handling potential NaNs gracefully (cast each column once)
+    def as_text(col):
+        if col not in facilities_df.columns:
+            return pd.Series('N/A', index=facilities_df.index)
+        return facilities_df[col].fillna('N/A').astype(str)
+    
+    # Coordinates are stored as float32; widen and round them so each one serializes in its short form
+    def as_coordinate(col):
+        return facilities_df[col].astype('float64').round(COORDINATE_DECIMALS)
+    
+    # Compact per-facility payload; markers and popups are built client-side from these positional fields:
+    # [lat, lng, fill color, type description, NPI, name, street address, city, state, zip, substance abuse flag, SUD clinic flag]
+    # (flags are serialized as true/false/null)
+    facility_payload = pd.DataFrame({
+        'lat': as_coordinate('Latitude'),
+        'lng': as_coordinate('Longitude'),
+        'fc': fill_color,
+        'desc': facility_type_desc,
+        'npi': as_text('NPI'),
+        'name': as_text('Group Name'),
+        'addr': as_text('Street Address'),
+        'city': as_text('City'),
+        'st': as_text('State'),
+        'zip': as_text('Zip'),
+        'sa': is_substance_abuse,
+        'sud': is_sud_clinic,
+    })
+    return facility_payload.to_json(orient='values', double_precision=COORDINATE_DECIMALS)
+
+def inject_facility_markers_into_html(original_html, payload_url):
+    """Inject a script into existing folium HTML that fetches the facility payload and adds color-coded markers"""
+    # Find the folium map variable (e.g. map_8a9495b6...) so the script can reference it directly
+    map_var_match = re.search(r'var (map_[0-9a-f]+) = L\.map', original_html)
+    if map_var_match is None:
+        return original_html
+    map_var = map_var_match.group(1)
+    
+    # Generate JavaScript code to add facility markers
+    facility_js_code = []
+    load_cluster_plugin = 'markercluster.css' not in original_html.lower()
+    
+    # Add MarkerCluster plugin if not already present
+    # Check for MarkerCluster.css as a proxy for whether it's already loaded
+    if load_cluster_plugin:
+        facility_js_code.append("""
+        // Add MarkerCluster CSS and JS
+        var clusterCSS = document.createElement('link');
+        clusterCSS.rel = 'stylesheet';
+        clusterCSS.href = 'https://unpkg.com/leaflet.markercluster@1.4.1/dist/MarkerCluster.css';
+        document.head.appendChild(clusterCSS);
+        
+        var clusterDefaultCSS = document.createElement('link');
+        clusterDefaultCSS.rel = 'stylesheet';
+        clusterDefaultCSS.href = 'https://unpkg.com/leaflet.markercluster@1.4.1/dist/MarkerCluster.Default.css';
+        document.head.appendChild(clusterDefaultCSS);
+        
+        var clusterJS = document.createElement('script');
+        clusterJS.src = 'https://unpkg.com/leaflet.markercluster@1.4.1/dist/leaflet.markercluster.js';
+        document.head.appendChild(clusterJS);
+        """)
+    
+    # Wait for map to be ready and add facility markers
+    facility_js_code.append("""
+        // Add facility markers once the MarkerCluster plugin is loaded and the folium map is ready
+        function addFacilityOverlay() {
+            var mapObj = """ + map_var + """;
+            
+            mapObj.whenReady(function() {
+                // Create marker cluster group
+                var facilityCluster = L.markerClusterGroup({
+                    showCoverageOnHover: false,
+                    zoomToBoundsOnClick: true,
+                    spiderfyOnMaxZoom: false,
+                    removeOutsideVisibleBounds: true,
+                    disableClusteringAtZoom: 13,
+                    // Build clusters in time-sliced chunks so the page stays responsive with many markers
+                    chunkedLoading: true
+                });
+                
+                // Add facility markers
+    """)
+    
+    facility_js_code.append("""
+                // Show nullable taxonomy flags as True/False/N/A
+                function flagText(v) {
+                    return v == null ? 'N/A' : (v ? 'True' : 'False');
+                }
+                
+                // Build popup HTML for a payload row (border color for markers is fixed to black for contrast)
+                function popupFor(r) {
+                    var coords = (r[0] != null && r[1] != null) ? r[0].toFixed(4) + ', ' + r[1].toFixed(4) : 'N/A';
+                    return '<b>NPI:</b> ' + r[4] + '<br>' +
+                        '<b>Facility Name:</b> ' + r[5] + '<br>' +
+                        '<b>Facility Type:</b> ' + r[3] + '<br>' +
+                        '<b>Street Address:</b> ' + r[6] + '<br>' +
+                        '<b>City:</b> ' + r[7] + '<br>' +
+                        '<b>State:</b> ' + r[8] + '<br>' +
+                        '<b>Zip:</b> ' + r[9] + '<br>' +
+                        '<b>Coordinates:</b> ' + coords + '<br>' +
+                        '<br>' +
+                        '<b>is_substance_abuse_rehab:</b> ' + flagText(r[10]) + '<br>' +
+                        '<b>is_sud_rehab_clinic:</b> ' + flagText(r[11]) + '<br>';
+                }
+                
+                // Popup content is built only when a popup opens (Leaflet calls this with the clicked marker)
+                function popupForLayer(layer) {
+                    return popupFor(layer.options.facilityRow);
+                }
+                
+                // Draw all facility markers onto one shared canvas instead of one SVG node per marker
+                var fcRenderer = L.canvas({padding: 0.5});
+                function buildMarkers(F) {
+                    var markers = [];
+                    for (var i = 0; i < F.length; i++) {
+                        var r = F[i];
+                        markers.push(L.circleMarker([r[0], r[1]], {
+                            renderer: fcRenderer,
+                            radius: 7,
+                            color: '#000000',
+                            weight: 2,
+                            opacity: 0.9,
+                            fillColor: r[2],
+                            fillOpacity: 0.7,
+                            facilityRow: r
+                        }).bindPopup(popupForLayer, {maxWidth: 300}));
+                    }
+                
+                    // Bulk-add so the cluster hierarchy is built once rather than re-clustering on every insert
+                    facilityCluster.addLayers(markers);
+                }
+                
+                // The payload is served as a static file so the map document itself stays small
+                fetch('""" + payload_url + """')
+                    .then(function(response) {
+                        if (!response.ok) {
+                            throw new Error('HTTP ' + response.status);
+                        }
+                        return response.json();
+                    })
+                    .then(buildMarkers)
+                    .catch(function(err) {
+                        console.error('Could not load facility markers from """ + payload_url + """:', err);
+                    });
+    """)
+    
+    # Close the JavaScript function and add legend
+    facility_js_code.append("""
+                // Add cluster to map
+                mapObj.addLayer(facilityCluster);
+                
+                // Add layer control if it doesn't exist
+                if (!mapObj.layerControl) {
+                    var baseLayers = {};
+                    var overlayLayers = {
+                        "Individual Facilities": facilityCluster
+                    };
+                    mapObj.layerControl = L.control.layers(baseLayers, overlayLayers).addTo(mapObj);
+                } else {
+                    // Check if "Individual Facilities" overlay already exists to avoid duplication on rerun
+                    var existingOverlays = mapObj.layerControl._layers.filter(layer => layer.overlay).map(layer => layer.name);
+                    if (!existingOverlays.includes("Individual Facilities")) {
+                        mapObj.layerControl.addOverlay(facilityCluster, "Individual Facilities");
+                    }
+                }
+            });
+        }
+    """)
+    
+    # Start once the plugin script has loaded (it is fetched asynchronously) or right away if the map already includes it
+    if load_cluster_plugin:
+        facility_js_code.append("        clusterJS.onload = addFacilityOverlay;")
+    else:
+        facility_js_code.append("        addFacilityOverlay();")
+    
+    # Combine all JavaScript code
+    full_js_code = '\n'.join(facility_js_code)
+    
+    # Inject the JavaScript into the HTML
+    script_tag = f'<script data-facility-overlay-version="{OVERLAY_FORMAT_VERSION}">{full_js_code}</script>'
+    
+    # Insert before the closing </html> tag - folium emits the map script after </body>, and the map variable must exist first
+    if '</html>' in original_html:
+        head, _, tail = original_html.rpartition('</html>')
+        modified_html = f'{head}{script_tag}\n</html>{tail}'
+    else:
+        # If no </html> tag found, append to the end
+        modified_html = original_html + script_tag
+    
+    return modified_html
+
+def fingerprint_facility_data(facilities_df):
+    """Return a hash of the facility data and the overlay format, used to name the payload file and key the cached map HTML"""
+    row_hashes = pd.util.hash_pandas_object(facilities_df, index=False).values
+    fingerprint = hashlib.sha1(f"overlay-format-{OVERLAY_FORMAT_VERSION}".encode())
+    fingerprint.update(row_hashes.tobytes())
+    return fingerprint.hexdigest()
+
+def write_facility_payload(facilities_df, facility_hash, static_dir):
+    """Write the facility payload into the static folder (once per fingerprint) and return its URL"""
+    payload_path = static_dir / f"facilities_{facility_hash}.json"
+    if not payload_path.exists():
+        static_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a uniquely named temp file then rename, so a concurrent session never fetches a half-written file and
+        # sessions racing on the same fingerprint don't clobber each other's temp file (the last identical rename wins)
+        tmp_file = tempfile.NamedTemporaryFile(
+            'w', encoding='utf-8', dir=static_dir, prefix=f"{payload_path.name}.", suffix='.tmp', delete=False
+        )
+        try:
+            with tmp_file:
+                tmp_file.write(build_facility_payload(facilities_df))
+            os.replace(tmp_file.name, payload_path)
+        except OSError:
+            # Another session having already written the (identical) payload is fine
+            if not payload_path.exists():
+                raise
+        finally:
+            if os.path.exists(tmp_file.name):
+                os.remove(tmp_file.name)
+    return f"{STATIC_URL_PATH}/{payload_path.name}"
+
+# --- Pre-rendered overlays (written by scripts/prebuild_overlays.py) ---
+def prebuilt_overlay_path(map_path):
+    """Path of the pre-rendered overlay HTML for a saved map, e.g. data/maps/<base>.facilities.html"""
+    return map_path.with_suffix('.facilities.html')
+
+def find_prebuilt_overlay(map_path, facility_files):
+    """Return the pre-rendered overlay for map_path if it is newer than the map and all facility files; otherwise None"""
+    overlay_path = prebuilt_overlay_path(map_path)
+    if not overlay_path.exists() or not map_path.exists():
+        return None
+    
+    overlay_mtime_ns = overlay_path.stat().st_mtime_ns
+    source_paths = [map_path, *facility_files]
+    if any(path.stat().st_mtime_ns >= overlay_mtime_ns for path in source_paths):
+        return None
+    
+    return overlay_path
+
+def overlay_format_matches(overlay_html):
+    """Check that a pre-rendered overlay was written by the current version of the injected script and payload format"""
+    return f'data-facility-overlay-version="{OVERLAY_FORMAT_VERSION}"' in overlay_html
+
+def overlay_payload_name(overlay_html):
+    """Return the name of the payload file a pre-rendered overlay fetches from the static folder, or None if it has none"""
+    payload_name = re.search(re.escape(STATIC_URL_PATH) + r'/(facilities_[0-9a-f]+\.json)', overlay_html)
+    return payload_name.group(1) if payload_name is not None else None
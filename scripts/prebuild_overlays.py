@@ -0,0 +1,68 @@
+"""Pre-render the facility overlay for every saved map so the app can serve it with a plain file read.
+
+Run from anywhere after regenerating the maps or the facility location files:
+
+    python scripts/prebuild_overlays.py
+
+Writes data/maps/<base>.facilities.html next to each map and the payloads they fetch into ./static.
+"""
+import re
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from facility_overlay import (  # noqa: E402
+    load_facility_file, combine_facility_frames, filter_facilities_for_type, fingerprint_facility_data,
+    write_facility_payload, inject_facility_markers_into_html, prebuilt_overlay_path
+)
+
+FACILITY_LOCATION_FILES_DIR = PROJECT_ROOT / 'data' / 'facility_location_files'
+MAPS_DIR = PROJECT_ROOT / 'data' / 'maps'
+STATIC_DIR = PROJECT_ROOT / 'static'
+
+# Saved map names look like state_map_SUD_Rehab_Clinics_Raw / zipcode_map_All_Healthcare_Facilities_per_100k
+MAP_NAME_PATTERN = re.compile(r'^(?:state|zipcode)_map_(?P<facility_type>.+)_(?:Raw|per_100k)$')
+
+
+def main():
+    # Load and combine all facility CSV files
+    facility_frames = []
+    for csv_file in sorted(FACILITY_LOCATION_FILES_DIR.glob('*.csv')):
+        facility_df, warning_message = load_facility_file(csv_file)
+        if warning_message:
+            print(f"Warning: {warning_message}")
+        if facility_df is not None:
+            facility_frames.append(facility_df)
+
+    facilities_df = combine_facility_frames(facility_frames)
+    if facilities_df is None:
+        print(f"No facility data loaded from {FACILITY_LOCATION_FILES_DIR}. Nothing to pre-render.")
+        return 1
+
+    for map_path in sorted(MAPS_DIR.glob('*.html')):
+        if map_path.name.endswith('.facilities.html'):
+            continue
+        match = MAP_NAME_PATTERN.match(map_path.stem)
+        if match is None:
+            print(f"Skipping {map_path.name}: unrecognized map name.")
+            continue
+
+        facility_type = match.group('facility_type').replace('_', ' ')
+        map_facilities = filter_facilities_for_type(facilities_df, facility_type)
+        if map_facilities.empty:
+            print(f"Skipping {map_path.name}: no facilities match '{facility_type}'.")
+            continue
+
+        payload_url = write_facility_payload(map_facilities, fingerprint_facility_data(map_facilities), STATIC_DIR)
+        map_html = map_path.read_text(encoding='utf-8')
+        overlay_path = prebuilt_overlay_path(map_path)
+        overlay_path.write_text(inject_facility_markers_into_html(map_html, payload_url), encoding='utf-8')
+        print(f"Wrote {overlay_path.name} ({len(map_facilities):,} facilities)")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())